@@ -17,19 +17,29 @@ SERVICE_NAME_PREFIX = 'com.victronenergy.battery.'
 
 SOFTWARE_VERSION = '2.2.0'
 UPDATE_INTERVAL = 2000   # milliseconds
-LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = logging.INFO  # per cycle activity is recorded by tracer.py instead
+TRACE_SIZE = 4096        # number of events kept in the trace ring
+TRACE_FILE = '/tmp/dbus-fzsonick-48tl.trace'  # written on SIGUSR1 or /Debug/DumpTrace, decode with tracer.py
 
 # modbus configuration
 
 BASE_ADDRESS = 999
 NO_OF_REGISTERS = 56
 MAX_SLAVE_ADDRESS = 10
+MAX_READ_ATTEMPTS = 2   # read attempts per battery and update cycle, only while the battery is responsive
+MAX_BACKOFF = 60        # seconds, upper bound of the retry delay for an unresponsive battery
+RETIRE_AFTER_FAILURES = 10  # failed update cycles in a row after which the service of a battery is removed
+
+# An unresponsive battery is retried after 4, 8, 16 and 32 seconds (UPDATE_INTERVAL doubled per failure),
+# then every MAX_BACKOFF seconds. With the values above its service is thus removed after about
+# 6 minutes of silence, so a battery that only drops out for a minute or two keeps its service.
 
 
 # RS 485 configuration
 
 PARITY = serial.PARITY_NONE
 TIMEOUT = 0.2  # seconds
+PROBE_TIMEOUT = 0.05  # seconds, used when probing unused addresses for new batteries
 BAUD_RATE = 115200
 BYTE_SIZE = 8
 STOP_BITS = 2
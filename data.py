@@ -75,6 +75,16 @@ class Battery(object):
 			self.slave_address, self.hardware_version, self.firmware_version, self.bms_version, str(self.ampere_hours))
 
 
+class SlaveHealth(object):
+
+	""" Data record to track the responsiveness of a modbus slave """
+
+	def __init__(self):
+		# type: () -> None
+		self.failures = 0         # consecutive failed update cycles
+		self.next_attempt = 0.0   # earliest time.time() at which the slave may be polled again
+
+
 class BatteryStatus(object):
 	"""
 	record holding the current status of a battery
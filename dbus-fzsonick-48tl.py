@@ -4,16 +4,25 @@
 import re
 import gobject
 import sys
+import time
 import logging
 
 import config as cfg
 import convert as c
+import tracer
+import signal
 
+import itertools
 import threading
 from threading import  Lock
 
 mutex = Lock()
 
+health = {}    # slave_address -> SlaveHealth, tracks unresponsive batteries
+services = {}  # slave_address -> (bat_number, DBus), the services of all exposed batteries
+bus_busy = 0.0  # seconds the bus was in use since the last run of the probe task
+probe_cost = 2 * cfg.PROBE_TIMEOUT  # moving average of the bus time a single probe takes
+
 from pymodbus.register_read_message import ReadInputRegistersResponse
 from pymodbus.client.sync import ModbusSerialClient as Modbus
 from pymodbus.other_message import ReportSlaveIdRequest
@@ -21,7 +30,8 @@ from pymodbus.exceptions import ModbusException
 from pymodbus.pdu import ExceptionResponse
 
 from dbus.mainloop.glib import DBusGMainLoop
-from data import BatteryStatus, Signal, Battery, LedColor
+from data import BatteryStatus, Signal, Battery, LedColor, SlaveHealth
+from tracer import Event
 
 from collections import Iterable
 from os import path
@@ -163,12 +173,34 @@ def init_dbus(tty, signals):
 	dbus = DBus(servicename=cfg.SERVICE_NAME_PREFIX + tty)
 
 	logging.debug('initializing DBus paths')
-	for signal in signals:
-		init_dbus_path(dbus, signal)
+	for sig in signals:
+		init_dbus_path(dbus, sig)
+
+	def dump_trace(path, value):
+		# type: (str, int) -> bool
+		if value:
+			dump_trace_ring()
+			gobject.idle_add(lambda: dbus.__setitem__(path, 0))  # re-arm for the next dump
+		return True
+
+	dbus.add_path('/Debug/DumpTrace', 0, writeable=True, onchangecallback=dump_trace)
 
 	return dbus
 
 
+def dump_trace_ring():
+	# type: () -> bool
+
+	logging.info('dumping trace to ' + cfg.TRACE_FILE)
+
+	try:
+		tracer.dump(cfg.TRACE_FILE)
+	except (IOError, OSError) as e:
+		logging.info('failed to dump trace : ' + str(e))
+
+	return False  # run only once when scheduled by gobject.idle_add
+
+
 # noinspection PyBroadException
 def try_get_value(sig):
 	# type: (Signal) -> object
@@ -197,10 +229,6 @@ def init_main_loop():
 def report_slave_id(modbus, slave_address):
 	# type: (Modbus, int) -> str
 
-	slave = str(slave_address)
-
-	logging.debug('requesting slave id from node ' + slave)
-
 	try:
 		mutex.acquire()
 		modbus.connect()
@@ -209,7 +237,7 @@ def report_slave_id(modbus, slave_address):
 		response = modbus.execute(request)
 
 		if response is ExceptionResponse or issubclass(type(response), ModbusException):
-			raise Exception('failed to get slave id from ' + slave + ' : ' + str(response))
+			raise Exception('failed to get slave id from ' + str(slave_address) + ' : ' + str(response))
 
 		return response.identifier
 
@@ -221,8 +249,6 @@ def report_slave_id(modbus, slave_address):
 def identify_battery(modbus, slave_address):
 	# type: (Modbus, int) -> Battery
 
-	logging.info('identifying battery...')
-
 	hardware_version, bms_version, ampere_hours = parse_slave_id(modbus, slave_address)
 	firmware_version = read_firmware_version(modbus, slave_address)
 
@@ -245,6 +271,7 @@ def identify_batteries(modbus):
 		address_range = range(2, cfg.MAX_SLAVE_ADDRESS + 2)
 
 		for slave_address in address_range:
+			logging.debug('identifying battery at {0}'.format(slave_address))
 			try:
 				yield identify_battery(modbus, slave_address)
 			except Exception as e:
@@ -290,12 +317,15 @@ def read_firmware_version(modbus, slave_address):
 def read_modbus_registers(modbus, slave_address, base_address=cfg.BASE_ADDRESS, count=cfg.NO_OF_REGISTERS):
 	# type: (Modbus, int) -> ReadInputRegistersResponse
 
-	logging.debug('requesting modbus registers {0}-{1}'.format(base_address, base_address + count))
+	start = time.time()
 
-	return modbus.read_input_registers(
-		address=base_address,
-		count=count,
-		unit=slave_address)
+	try:
+		return modbus.read_input_registers(
+			address=base_address,
+			count=count,
+			unit=slave_address)
+	finally:
+		tracer.record(Event.read_registers, slave_address, time.time() - start)
 
 
 def read_battery_status(modbus, battery):
@@ -304,8 +334,6 @@ def read_battery_status(modbus, battery):
 	Read the modbus registers containing the battery's status info.
 	"""
 
-	logging.debug('reading battery status')
-
 	try:
 		mutex.acquire()
 		modbus.connect()
@@ -317,6 +345,89 @@ def read_battery_status(modbus, battery):
 		mutex.release()
 
 
+def poll_battery(modbus, battery):
+	# type: (Modbus, Battery) -> BatteryStatus | None
+	"""
+	Read the status of a battery, guarded by its SlaveHealth record.
+
+	An unresponsive battery is skipped until its (exponentially growing)
+	backoff delay has expired, and gets only a single attempt per cycle,
+	so it cannot use up the bus time of the other batteries.
+	Returns None if no fresh status is available.
+	"""
+
+	global bus_busy
+
+	slave_health = health.setdefault(battery.slave_address, SlaveHealth())
+
+	# a wait longer than MAX_BACKOFF means the clock was stepped back, retry right away
+	wait = slave_health.next_attempt - time.time()
+
+	if 0 < wait <= cfg.MAX_BACKOFF:
+		tracer.record(Event.backoff_skip, battery.slave_address)
+		return None
+
+	attempts = cfg.MAX_READ_ATTEMPTS if slave_health.failures == 0 else 1
+	error = None
+
+	for _ in range(attempts):
+		start = time.time()
+		try:
+			status = read_battery_status(modbus, battery)
+		except Exception as e:
+			tracer.record(Event.read_failed, battery.slave_address, time.time() - start)
+			error = e
+			continue
+		finally:
+			bus_busy += time.time() - start
+
+		if slave_health.failures > 0:
+			logging.info('battery at {0} is responding again'.format(battery.slave_address))
+
+		slave_health.failures = 0
+		slave_health.next_attempt = 0.0
+		return status
+
+	slave_health.failures += 1
+	delay = min(cfg.UPDATE_INTERVAL / 1000.0 * 2 ** min(slave_health.failures, 16), cfg.MAX_BACKOFF)
+	slave_health.next_attempt = time.time() + delay
+
+	logging.info('failed to read battery at {0} : {1}, retrying in {2:.1f}s'.format(battery.slave_address, str(error), delay))
+
+	return None
+
+
+def has_disappeared(battery):
+	# type: (Battery) -> bool
+	slave_health = health.get(battery.slave_address)
+	return slave_health is not None and slave_health.failures >= cfg.RETIRE_AFTER_FAILURES
+
+
+def probe_battery(modbus, slave_address):
+	# type: (Modbus, int) -> Battery | None
+	"""
+	Try to identify a battery at an unused slave address,
+	using the short PROBE_TIMEOUT instead of the regular one.
+	"""
+
+	global bus_busy, probe_cost
+
+	modbus.timeout = cfg.PROBE_TIMEOUT
+	start = time.time()
+
+	try:
+		return identify_battery(modbus, slave_address)
+	except Exception:
+		return None
+	finally:
+		modbus.timeout = cfg.TIMEOUT
+		duration = time.time() - start
+		bus_busy += duration
+		if 0 <= duration < cfg.UPDATE_INTERVAL / 1000.0:  # ignore clock steps
+			probe_cost += (duration - probe_cost) / 4  # a single slow probe must not stop probing for good
+		tracer.record(Event.probe, slave_address, duration)
+
+
 def publish_values(dbus, signals, statuses):
 	# type: (DBus, Iterable[Signal], Iterable[BatteryStatus]) -> ()
 
@@ -335,15 +446,29 @@ def update(modbus, batteries, dbus, signals):
 	2. parses the data using Signal.get_value
 	3. aggregates the data from all batteries into one datum using Signal.aggregate
 	4. publishes the data on the dbus
+
+	Batteries that do not respond are left out, if none responds the
+	published values are marked as stale by clearing /Connected.
 	"""
 
-	logging.debug('starting update cycle')
+	start = time.time()
+
+	for battery in batteries:
+		tracer.record(Event.update_start, battery.slave_address)
+
+	statuses = [poll_battery(modbus, battery) for battery in batteries]
+	statuses = [status for status in statuses if status is not None]
 
-	statuses = [read_battery_status(modbus, battery) for battery in batteries]
+	if statuses:
+		publish_values(dbus, signals, statuses)
+	else:
+		dbus['/Connected'] = 0
 
-	publish_values(dbus, signals, statuses)
+	duration = time.time() - start
+
+	for battery in batteries:
+		tracer.record(Event.update_end, battery.slave_address, duration)
 
-	logging.debug('finished update cycle\n')
 	return True
 
 
@@ -383,17 +508,21 @@ def create_update_task(modbus, dbus, batteries, signals, main_loop):
 		if not alive:
 			logging.info('update_task: quitting main loop because of error')
 			main_loop.quit()
+		elif all(has_disappeared(battery) for battery in batteries):
+			retire_service(dbus, batteries)
+			return False
 
 		return alive
 
 	return update_task
 
 
-def create_watchdog_task(main_loop):
-	# type: (DBusGMainLoop) -> Callable[[],bool]
+def create_watchdog_task(main_loop, dbus):
+	# type: (DBusGMainLoop, DBus) -> Callable[[],bool]
 	"""
 	Creates a Watchdog task that monitors the alive flag.
 	The watchdog kills the main loop if the alive flag is not periodically reset by the update task.
+	It stops by itself once the service it belongs to has been retired.
 	Who watches the watchdog?
 	"""
 	def watchdog_task():
@@ -401,8 +530,11 @@ def create_watchdog_task(main_loop):
 
 		global alive
 
+		if not any(d is dbus for _, d in services.values()):
+			return False
+
 		if alive:
-			logging.debug('watchdog_task: update_task is alive')
+			tracer.record(Event.watchdog)
 			alive = False
 			return True
 		else:
@@ -412,14 +544,71 @@ def create_watchdog_task(main_loop):
 
 	return watchdog_task
 
+
+def create_probe_task(modbus, main_loop):
+	# type: (Modbus, DBusGMainLoop) -> Callable[[],bool]
+	"""
+	Creates a probe task that detects batteries added after startup.
+	Every UPDATE_INTERVAL it probes a single unused slave address, but only
+	if the bus time left idle during the last interval (by the update tasks
+	and the previous probe) is at least the average time a probe takes.
+	"""
+
+	addresses = itertools.cycle(range(2, cfg.MAX_SLAVE_ADDRESS + 2))
+
+	def probe_task():
+		# type: () -> bool
+
+		global bus_busy
+
+		idle = cfg.UPDATE_INTERVAL / 1000.0 - bus_busy
+		bus_busy = 0.0
+
+		if idle < probe_cost:
+			return True
+
+		for _ in range(cfg.MAX_SLAVE_ADDRESS):
+			slave_address = next(addresses)
+			if slave_address not in services:
+				break
+		else:
+			return True  # all addresses in use
+
+		battery = probe_battery(modbus, slave_address)
+
+		if battery is not None:
+			used = set(bat_number for bat_number, _ in services.values())
+			bat_number = next(i for i in itertools.count() if i not in used)
+			try:
+				expose_battery(battery, bat_number, modbus, main_loop)
+			except Exception as e:
+				logging.info('failed to expose battery at {0} : {1}'.format(str(slave_address), str(e)))
+
+		return True
+
+	return probe_task
+
+
+def retire_service(dbus, batteries):
+	# type: (DBus, Iterable[Battery]) -> ()
+
+	for battery in batteries:
+		logging.info('battery at {0} disappeared, removing its service'.format(battery.slave_address))
+		services.pop(battery.slave_address, None)
+		health.pop(battery.slave_address, None)
+
+	dbus.__del__()  # releases the service name on the bus
+
+
 def expose_battery(bat, bat_number, modbus, main_loop):
 	signals = init_signals(bat.hardware_version, bat.firmware_version,bat_number, 1)
 
 	dbus = init_dbus("bat_" + str( bat_number ), signals)
+	services[bat.slave_address] = (bat_number, dbus)
 	batteries = []
 	batteries.append(bat)
 	update_task = create_update_task(modbus, dbus, batteries, signals, main_loop)
-	watchdog_task = create_watchdog_task(main_loop)
+	watchdog_task = create_watchdog_task(main_loop, dbus)
 
 	gobject.timeout_add(cfg.UPDATE_INTERVAL * 2, watchdog_task)  # add watchdog first
 	gobject.timeout_add(cfg.UPDATE_INTERVAL, update_task)        # call update once every update_interval
@@ -433,6 +622,9 @@ def main(argv):
 	logging.basicConfig(level=cfg.LOG_LEVEL)
 	logging.info('starting ' + __file__)
 
+	# only schedule the dump, the handler interrupts whatever code happens to run
+	signal.signal(signal.SIGUSR1, lambda *_: gobject.idle_add(dump_trace_ring))
+
 	tty = parse_cmdline_args(argv)
 	modbus = init_modbus(tty)
 
@@ -459,6 +651,8 @@ def main(argv):
 	for thread in threads:
 		thread.join()
 
+	gobject.timeout_add(cfg.UPDATE_INTERVAL, create_probe_task(modbus, main_loop))
+
 	logging.info('starting gobject.MainLoop')
 	main_loop.run()
 	logging.info('gobject.MainLoop was shut down')
@@ -0,0 +1,114 @@
+#!/usr/bin/python2 -u
+# coding=utf-8
+
+"""
+Fixed-size in-memory trace of the driver's bus activity.
+
+Events are packed into a preallocated ring buffer, without any string
+formatting, so recording them is cheap enough for every update cycle.
+The ring can be dumped to cfg.TRACE_FILE (on SIGUSR1 or by writing to
+/Debug/DumpTrace on DBus) and decoded into a timeline with:
+
+	tracer.py <dump file>
+"""
+
+import struct
+import sys
+import time
+
+import config as cfg
+
+
+class Event(object):
+	"""
+	event types recorded in the trace
+	"""
+	update_start = 0
+	update_end = 1
+	read_registers = 2
+	read_failed = 3
+	backoff_skip = 4
+	probe = 5
+	watchdog = 6
+
+
+RECORD = struct.Struct('<dBBI')  # timestamp, slave address (0: none), event, duration [us]
+HEADER = struct.Struct('<4sII')  # magic, ring size, number of events recorded
+MAGIC = b'FZTR'
+
+ring = bytearray(RECORD.size * cfg.TRACE_SIZE)
+position = 0  # number of events recorded so far, the ring wraps around
+
+
+def record(event, slave_address=0, duration=0.0):
+	# type: (int, int, float) -> ()
+
+	global position
+
+	offset = (position % cfg.TRACE_SIZE) * RECORD.size
+	RECORD.pack_into(ring, offset, time.time(), slave_address, event, max(0, min(int(duration * 1000000), 0xFFFFFFFF)))  # clock steps must not raise
+	position += 1
+
+
+def dump(file_name=cfg.TRACE_FILE):
+	# type: (str) -> ()
+
+	with open(file_name, 'wb') as f:
+		f.write(HEADER.pack(MAGIC, cfg.TRACE_SIZE, position))
+		f.write(ring)
+
+
+def load(file_name):
+	# type: (str) -> list[(float, int, int, int)]
+	"""
+	reads a dump and returns its events, oldest first:
+	(timestamp, slave address, event, duration [us])
+	"""
+
+	with open(file_name, 'rb') as f:
+		data = f.read()
+
+	magic, size, count = HEADER.unpack_from(data)
+
+	if magic != MAGIC:
+		raise Exception('not a trace dump: ' + file_name)
+
+	def unpack(i):
+		return RECORD.unpack_from(data, HEADER.size + (i % size) * RECORD.size)
+
+	return [unpack(i) for i in range(max(count - size, 0), count)]
+
+
+def format_timeline(events):
+	# type: (list[(float, int, int, int)]) -> Iterable[str]
+
+	names = dict((v, k) for k, v in vars(Event).items() if not k.startswith('_'))
+	previous = None
+
+	for timestamp, slave_address, event, duration in events:
+		delta = 0.0 if previous is None else (timestamp - previous) * 1000
+		previous = timestamp
+
+		yield '{0}.{1:03d} {2:+9.1f}ms  slave {3:>3}  {4:<15} {5:>9.3f}ms'.format(
+			time.strftime('%H:%M:%S', time.localtime(timestamp)),
+			int(timestamp * 1000) % 1000,
+			delta,
+			slave_address or '-',
+			names.get(event, str(event)),
+			duration / 1000.0)
+
+
+def main(argv):
+	# type: (list[str]) -> ()
+
+	if len(argv) == 0:
+		print ('Usage:   ' + __file__ + ' <trace dump>')
+		print ('Example: ' + __file__ + ' ' + cfg.TRACE_FILE)
+		sys.exit(1)
+
+	for line in format_timeline(load(argv[0])):
+		print (line)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])